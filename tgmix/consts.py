@@ -2,3 +2,9 @@ MEDIA_KEYS = [
     "photo", "video_file", "voice_message",
     "video_message", "sticker", "file"
 ]
+
+MEDIA_KEYS_SET = frozenset(MEDIA_KEYS)
+
+TRANSCRIBABLE_TYPES = (
+    "voice_messages", "round_video_messages", "video_files"
+)
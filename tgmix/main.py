@@ -138,13 +138,16 @@ def run_processing(target_dir: Path, config: dict,
 
     message_processor = MessageProcessor(
         target_dir, media_dir, config["mark_media"], masking_rules,
-        do_anonymise)
+        do_anonymise,
+        config if config.get("transcribe_media", False) else None)
 
     # Stitch messages together
     stitched_messages, author_map, is_anonymised = (
         message_processor.stitch_messages(raw_chat["messages"]))
 
     message_processor.fix_reply_ids(stitched_messages)
+    is_transcribed = message_processor.attach_transcriptions(
+        stitched_messages)
 
     chat_name = raw_chat.get("name")
     if is_anonymised and ("authors" in masking_rules.get("presets", {})):
@@ -165,7 +168,7 @@ def run_processing(target_dir: Path, config: dict,
 
     # Format and save the final result
     processed_chat = create_summary_block(
-        False,
+        is_transcribed,
         "(File not included. "
         "Change data exporting settings to download.)" in str(raw_chat)
     )
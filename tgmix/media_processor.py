@@ -1,50 +1,233 @@
 # tgmix/media_processor.py
+import os
+import subprocess
+from bisect import bisect_left
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import groupby
+from multiprocessing import get_all_start_methods, get_context
 from pathlib import Path
-from shutil import copyfile
+from stat import S_ISDIR, S_ISLNK
 
 from markmymedia import mark_audio, mark_image, mark_video
 from markmymedia.errors import (
     AudioMarkingError, FFmpegProcessError, ImageMarkingError,
     InvalidMediaError, VideoMarkingError)
+from tqdm import tqdm
 
-from tgmix.consts import MEDIA_KEYS
+from tgmix.consts import MEDIA_KEYS, MEDIA_KEYS_SET, TRANSCRIBABLE_TYPES
+
+# Placeholders Telegram writes instead of a filename when a file
+# was not exported.
+UNAVAILABLE_FILES = frozenset({
+    "(File not included. "
+    "Change data exporting settings to download.)",
+    "(File exceeds maximum size. "
+    "Change data exporting settings to download.)",
+    "(File unavailable, please try again later)",
+})
+
+# Upper bounds (seconds) of the duration buckets used to group files
+# of similar length into the same batch.
+DURATION_BUCKETS = (10, 30, 120, 600)
+
+# Files longer than this get a reduced segment batch size to keep
+# activation memory bounded.
+LONG_MEDIA_SECONDS = 600
+
+# Tighter speech cuts than the silero defaults: voice messages rarely
+# contain long meaningful silences.
+VAD_PARAMETERS = {"min_silence_duration_ms": 500, "speech_pad_ms": 200}
+
+COPY_BUFFER_SIZE = 1 << 20
+
+worker_model = None
+
+
+def copy_file_contents(source_path: Path, output_path: Path) -> None:
+    """
+    Copies file contents via copy_file_range when the kernel supports it
+    (enabling server-side and reflink copies), falling back to a buffered
+    readinto loop.
+    """
+    with (open(source_path, "rb") as source,
+          open(output_path, "wb") as output):
+        if hasattr(os, "copy_file_range"):
+            try:
+                while os.copy_file_range(
+                        source.fileno(), output.fileno(), 2 ** 30):
+                    pass
+                return
+            except OSError:
+                # Unsupported filesystem combination, start over.
+                source.seek(0)
+                output.seek(0)
+                output.truncate()
+
+        buffer = bytearray(COPY_BUFFER_SIZE)
+        view = memoryview(buffer)
+        while read := source.readinto(buffer):
+            output.write(view[:read])
+
+
+def probe_duration(source_path: str) -> float:
+    """Returns the media duration in seconds, or 0.0 if ffprobe fails."""
+    try:
+        output = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+             "-of", "default=noprint_wrappers=1:nokey=1", source_path],
+            capture_output=True, text=True, check=True)
+        return float(output.stdout.strip())
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return 0.0
+
+
+def resolve_device(worker_config: dict) -> str:
+    import ctranslate2
+
+    device = worker_config.get("transcription_device", "auto")
+    if device == "auto":
+        device = "cuda" if ctranslate2.get_cuda_device_count() else "cpu"
+    return device
+
+
+def load_model(worker_config: dict, device: str, num_workers: int = 1):
+    from faster_whisper import BatchedInferencePipeline, WhisperModel
+
+    compute_type = worker_config.get("transcription_compute_type", "auto")
+    if compute_type == "auto":
+        # int8_float16 halves the bytes moved through the encoder on GPU
+        # and lets CTranslate2 use INT8 GEMM / FP16 tensor cores.
+        compute_type = "int8_float16" if device == "cuda" else "int8"
+
+    print(f"[*] Loading Whisper model on '{device}' ({compute_type})")
+    return BatchedInferencePipeline(model=WhisperModel(
+        worker_config.get("transcription_model", "small"),
+        device=device, compute_type=compute_type, num_workers=num_workers))
+
+
+def init_worker(worker_config: dict) -> None:
+    """Loads the Whisper model once per worker process."""
+    global worker_model
+    # One BLAS pool per worker process is enough.
+    os.environ.setdefault("OMP_NUM_THREADS", "1")
+    worker_model = load_model(worker_config, resolve_device(worker_config))
+
+
+def transcribe_batch_worker(source_items: list) -> dict[str, str]:
+    """
+    Transcribes a batch of (path, duration) items and returns
+    {source path: text}.
+    """
+    results = {}
+    for source_path, duration in source_items:
+        # The pipeline VAD-splits the audio and batches the speech
+        # segments; long videos get a smaller segment batch so
+        # activation memory stays roughly constant.
+        batch_size = 4 if duration > LONG_MEDIA_SECONDS else 16
+        try:
+            segments, _ = worker_model.transcribe(
+                source_path, batch_size=batch_size, beam_size=1, best_of=2,
+                vad_filter=True, vad_parameters=VAD_PARAMETERS)
+            results[source_path] = " ".join(
+                segment.text.strip() for segment in segments)
+        except Exception as e:
+            print(f"[!] Failed to transcribe: {source_path}\n{e}")
+    return results
 
 
 class Media:
-    def __init__(self, base_dir: Path, media_dir: Path, mark_media: bool):
+    def __init__(self, base_dir: Path, media_dir: Path, mark_media: bool,
+                 transcription_config: dict | None = None):
         self.base_dir = base_dir
+        self._resolved_base = base_dir.resolve()
+        # Plain-string counterparts for the per-message hot path:
+        # os.path is several times cheaper than pathlib arithmetic.
+        self._base_str = os.fspath(self._resolved_base)
+        self._media_str = os.fspath(media_dir)
         self.media_dir = media_dir
         self.do_mark_media = mark_media
+        self.transcription_config = transcription_config
+        self.transcription_queue: dict[str, Path] = {}
+        self._copy_pool = ThreadPoolExecutor(max_workers=8)
+        self._pending_copies: list[Future] = []
+        self._prepared: set[Path] = set()
+        # dirname -> realpath; exports only have a handful of media
+        # subdirectories, so symlink-chasing them amortizes to nothing.
+        self._real_dir_cache: dict[str, str] = {}
 
     @staticmethod
     def detect(message: dict) -> str:
+        # Dict-view intersection runs in C and bails out fast for the
+        # common case of a message without media.
+        found = message.keys() & MEDIA_KEYS_SET
+        if not found:
+            return ""
+        if len(found) == 1:
+            return next(iter(found))
+
+        # Several media keys in one message: keep MEDIA_KEYS priority.
         for key in MEDIA_KEYS:
-            if key in message:
+            if key in found:
                 return key
         return ""
 
     def check_path(self, filename: str):
+        # normpath needs no syscalls, unlike a full resolve(); the
+        # containment check then costs a single lstat per file.
+        source_str = os.path.normpath(
+            os.path.join(self._base_str, filename))
+        if not source_str.startswith(self._base_str + os.sep):
+            print("[!] Security Warning: Blocked attempt to access a file "
+                  f"outside the base directory: {filename}")
+            return "OOB", Path(source_str), ""  # Out Of Bounds
+
+        # The directory component must be chased too: a symlinked
+        # subdirectory would otherwise smuggle files from outside the
+        # export past the prefix check above.
+        source_dir = os.path.dirname(source_str)
+        if (real_dir := self._real_dir_cache.get(source_dir)) is None:
+            real_dir = os.path.realpath(source_dir)
+            self._real_dir_cache[source_dir] = real_dir
+        if real_dir != self._base_str and not real_dir.startswith(
+                self._base_str + os.sep):
+            print("[!] Security Warning: Blocked attempt to access a file "
+                  f"outside the base directory: {filename}")
+            return "OOB", Path(source_str), ""
+
         try:
-            source_path = self.base_dir / filename
-            resolved_source = source_path.resolve(strict=True)
-            resolved_base = self.base_dir.resolve()
+            source_stat = os.lstat(source_str)
         except FileNotFoundError:
             print(f"[!] Skipped: File not found: {filename}")
-            return "NF", ""  # Not found
-        except Exception as e:
+            return "NF", "", ""  # Not found
+        except (OSError, ValueError) as e:
+            # ValueError covers filenames with embedded null bytes.
             print(f"[!] Skipped (error resolving path for '{filename}'):\n"
                   f"{e}")
-            return "NF", ""
+            return "NF", "", ""
 
-        if not resolved_source.is_relative_to(resolved_base):
-            print("[!] Security Warning: Blocked attempt to access a file "
-                  f"outside the base directory: {filename}")
-            return "OOB", resolved_source  # Out Of Bounds
-        if resolved_source.is_dir():
+        if S_ISLNK(source_stat.st_mode):
+            # Genuine exports contain no symlinks; chase and re-check
+            # the rare ones the expensive way.
+            try:
+                resolved_source = Path(source_str).resolve(strict=True)
+            except OSError:
+                print(f"[!] Skipped: File not found: {filename}")
+                return "NF", "", ""
+
+            if not resolved_source.is_relative_to(self._resolved_base):
+                print("[!] Security Warning: Blocked attempt to access a "
+                      f"file outside the base directory: {filename}")
+                return "OOB", resolved_source, ""
+
+            source_str = os.fspath(resolved_source)
+            source_stat = os.stat(source_str)
+
+        if S_ISDIR(source_stat.st_mode):
             print(f"[!] Skipped: Path points to a directory: {filename}")
-            return "isdir", resolved_source
+            return "isdir", Path(source_str), ""
 
-        return "", resolved_source
+        file_type = os.path.basename(os.path.dirname(source_str))
+        return "", Path(source_str), file_type
 
     def process(self, message: dict) -> str | None:
         """
@@ -58,26 +241,107 @@ class Media:
         if not isinstance(filename, str) or not filename:
             return
 
-        if filename in ("(File not included. "
-                        "Change data exporting settings to download.)",
-                        "(File exceeds maximum size. "
-                        "Change data exporting settings to download.)",
-                        "(File unavailable, please try again later)"):
+        if filename in UNAVAILABLE_FILES:
             return "B"
 
-        output_code, resolved_source = self.check_path(filename)
+        output_code, resolved_source, file_type = self.check_path(filename)
         if output_code:
             return output_code
 
-        prepared_path = self.media_dir / resolved_source.name
+        prepared_path = Path(os.path.join(
+            self._media_str, os.path.basename(os.fspath(resolved_source))))
+
+        if (self.transcription_config
+                and file_type in TRANSCRIBABLE_TYPES):
+            self.transcription_queue[filename] = resolved_source
+
+        # Forwarded messages reference the same file repeatedly; copy or
+        # mark each destination only once.
+        if prepared_path in self._prepared:
+            return filename
+        self._prepared.add(prepared_path)
 
         if not self.do_mark_media:
             self.copy_media_file(resolved_source, prepared_path)
             return filename
 
-        self.mark_media(resolved_source, prepared_path)
+        self.mark_media(resolved_source, prepared_path, file_type)
         return filename
 
+    def batch_transcribe(self) -> dict[str, str]:
+        """
+        Transcribes all queued voice/video messages in batches.
+        Returns {filename: transcribed text}.
+        """
+        if not self.transcription_queue:
+            return {}
+
+        try:
+            import faster_whisper  # noqa: F401
+        except ImportError:
+            print("[!] faster-whisper is not installed. "
+                  "Install 'tgmix[transcription]' to enable transcription.")
+            return {}
+
+        path_to_filename = {
+            str(source_path): filename
+            for filename, source_path in self.transcription_queue.items()}
+
+        # Group files of similar duration so a short voice message is
+        # never batched together with a long video.
+        source_paths_with_duration = {
+            source_path: probe_duration(source_path)
+            for source_path in path_to_filename}
+        sorted_items = sorted(source_paths_with_duration.items(),
+                              key=lambda item: item[1])
+
+        batch_size = self.transcription_config.get(
+            "transcription_batch_size", 8)
+        batches = []
+        for _, bucket in groupby(
+                sorted_items,
+                key=lambda item: bisect_left(DURATION_BUCKETS, item[1])):
+            bucket_items = list(bucket)
+            batches.extend(
+                bucket_items[batch_start:batch_start + batch_size]
+                for batch_start in range(0, len(bucket_items), batch_size))
+
+        global worker_model
+        transcripts = {}
+        workers = min(self.transcription_config.get(
+            "transcription_workers", 2), len(batches))
+        device = resolve_device(self.transcription_config)
+
+        if device == "cuda":
+            # One shared model: per-process copies would replicate multi-GB
+            # weights in VRAM for no gain, since CUDA serializes kernels
+            # anyway. CTranslate2 releases the GIL, so threads suffice.
+            worker_model = load_model(self.transcription_config, device,
+                                      num_workers=workers)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for batch_result in tqdm(
+                        executor.map(transcribe_batch_worker, batches),
+                        total=len(batches), desc="Transcribing media"):
+                    transcripts.update(batch_result)
+            worker_model = None
+        else:
+            # fork keeps worker startup cheap (the model file stays warm
+            # in the page cache between loads), but every worker must
+            # build its own model: CTranslate2 spawns its compute threads
+            # at construction and threads do not survive fork, so an
+            # inherited model would hang on the first transcribe call.
+            use_fork = "fork" in get_all_start_methods()
+            ctx = get_context("fork" if use_fork else None)
+            with ctx.Pool(processes=workers, initializer=init_worker,
+                          initargs=(self.transcription_config,)) as pool:
+                for batch_result in tqdm(
+                        pool.imap_unordered(transcribe_batch_worker, batches),
+                        total=len(batches), desc="Transcribing media"):
+                    transcripts.update(batch_result)
+
+        return {path_to_filename[source_path]: text
+                for source_path, text in transcripts.items()}
+
     def _mark_media(self, func, source_path: Path,
                     prepared_path: Path) -> None:
         try:
@@ -93,25 +357,44 @@ class Media:
             self.do_mark_media = False
             self.copy_media_file(source_path, prepared_path)
 
-    def mark_media(self, source_path: Path,
-                   prepared_path: Path) -> None:
-        file_type = source_path.parent.name
-
-        if file_type == "voice_messages":
-            self._mark_media(mark_audio, source_path,
-                             prepared_path.with_suffix(".mp4"))
-        elif file_type in ("round_video_messages", "video_files"):
-            self._mark_media(mark_video, source_path, prepared_path)
-        elif file_type == "photos":
-            self._mark_media(mark_image, source_path, prepared_path)
-        else:
+    # file_type -> (marking function, output suffix override)
+    _MARK_DISPATCH = {
+        "voice_messages": (mark_audio, ".mp4"),
+        "round_video_messages": (mark_video, None),
+        "video_files": (mark_video, None),
+        "photos": (mark_image, None),
+    }
+
+    def mark_media(self, source_path: Path, prepared_path: Path,
+                   file_type: str) -> None:
+        entry = self._MARK_DISPATCH.get(file_type)
+        if not entry:
             self.copy_media_file(source_path, prepared_path)
+            return
 
-    @staticmethod
-    def copy_media_file(source_path: Path, output_path: Path) -> None:
-        """Simply copies a file if it exists."""
+        mark_func, suffix = entry
+        if suffix:
+            prepared_path = prepared_path.with_suffix(suffix)
+        self._mark_media(mark_func, source_path, prepared_path)
+
+    def copy_media_file(self, source_path: Path, output_path: Path) -> None:
+        """Queues a background copy of a file if it exists."""
         if not source_path.exists():
             print(f"[!] Skipped (not found): {source_path}")
             return
 
-        copyfile(source_path, output_path)
+        # Copies are IO-bound; overlapping them keeps the CPU free for
+        # stitching and marking.
+        self._pending_copies.append(self._copy_pool.submit(
+            copy_file_contents, source_path, output_path))
+
+    def finish_copies(self) -> None:
+        """Waits for all background media copies to finish."""
+        for pending_copy in self._pending_copies:
+            if error := pending_copy.exception():
+                print(f"[!] Failed to copy media: {error}")
+
+        self._pending_copies.clear()
+        # No copies are submitted after stitching; release the worker
+        # threads so batch_transcribe forks a single-threaded parent.
+        self._copy_pool.shutdown(wait=True)
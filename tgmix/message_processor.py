@@ -8,6 +8,18 @@ from tqdm import tqdm
 from tgmix.media_processor import Media
 from tgmix.utils import b64decode_forgiving
 
+# (prefix, suffix) pairs for entity types that are plain Markdown
+# wrappers; one dict lookup replaces a cascade of compares.
+ENTITY_WRAPPERS = {
+    "bold": ("**", "**"),
+    "italic": ("*", "*"),
+    "strikethrough": ("~~", "~~"),
+    "code": ("`", "`"),
+    "underline": ("<u>", "</u>"),
+    "spoiler": ("||", "||"),
+    "blockquote": ("> ", ""),
+}
+
 
 class Masking:
     def __init__(self, rules: dict | None, enabled: bool):
@@ -134,12 +146,18 @@ class Masking:
 
 class MessageProcessor:
     def __init__(self, target_dir: Path, media_dir: Path, mark_media: bool,
-                 masking_rules: dict, do_anonymise: bool) -> None:
-        self.media = Media(target_dir, media_dir, mark_media)
+                 masking_rules: dict, do_anonymise: bool,
+                 transcription_config: dict | None = None) -> None:
+        self.media = Media(target_dir, media_dir, mark_media,
+                           transcription_config)
         self.pbar = None
+        self._progress = 0
         self.id_to_author_map = {}
         self.masking = Masking(masking_rules, do_anonymise)
         self.id_alias_map = {}
+        # shape -> reaction dict of the message currently being stitched,
+        # so merging a reaction is one lookup instead of a list scan.
+        self._reaction_index: dict = {}
 
     def format_text_entities_to_markdown(self, entities: list) -> str:
         """
@@ -165,15 +183,11 @@ class MessageProcessor:
             if not text:
                 continue
 
+            if wrap := ENTITY_WRAPPERS.get(entity_type):
+                markdown_parts.append(f"{wrap[0]}{text}{wrap[1]}")
+                continue
+
             match entity_type:
-                case "bold":
-                    markdown_parts.append(f"**{text}**")
-                case "italic":
-                    markdown_parts.append(f"*{text}*")
-                case "strikethrough":
-                    markdown_parts.append(f"~~{text}~~")
-                case "code":
-                    markdown_parts.append(f"`{text}`")
                 case "pre":
                     markdown_parts.append(f"```{entity.get('language', '')}\n"
                                           f"{text}\n```")
@@ -199,10 +213,6 @@ class MessageProcessor:
                         markdown_parts.append(mask)
                         continue
                     markdown_parts.append(text)
-                case "underline":
-                    markdown_parts.append(f"<u>{text}</u>")
-                case "spoiler":
-                    markdown_parts.append(f"||{text}||")
                 case "custom_emoji":
                     markdown_parts.append(f"[emoji_{entity['document_id']}]")
                 case "bank_card":
@@ -211,8 +221,6 @@ class MessageProcessor:
                         markdown_parts.append(mask)
                         continue
                     markdown_parts.append(text)
-                case "blockquote":
-                    markdown_parts.append(f"> {text}")
                 case "link":
                     if self.masking.enabled and (
                             mask := masking_presets.get("link")):
@@ -241,83 +249,86 @@ class MessageProcessor:
         Step 1: Iterates through messages, gathers "raw" parts,
         and then parses them at once. Returns processed messages and maps.
         """
-        author_map = {}
-        author_counter = 1
+        # dict.fromkeys keeps first-appearance order and dedupes in C;
+        # the reversed comprehension leaves each author's first name.
+        unique_author_ids = dict.fromkeys(
+            message.get("from_id") for message in source_messages
+            if message.get("from_id"))
+        author_names = {
+            message.get("from_id"): message.get("from")
+            for message in reversed(source_messages)}
+
+        self.id_to_author_map = {
+            author_id: f"U{author_number}"
+            for author_number, author_id in enumerate(unique_author_ids, 1)}
 
-        for next_message in source_messages:
-            author_id = next_message.get("from_id")
-            if not author_id or author_id in self.id_to_author_map:
-                continue
-
-            compact_id = f"U{author_counter}"
-            self.id_to_author_map[author_id] = compact_id
-            author_map[compact_id] = {
-                "name": next_message.get("from"),
-                "id": author_id
-            }
+        author_map = {}
+        for author_id, compact_id in self.id_to_author_map.items():
+            name = author_names.get(author_id)
+            author_map[compact_id] = {"name": name, "id": author_id}
             self.masking.name_to_authors_map.setdefault(
-                next_message.get("from"), []).append(compact_id)
-            author_counter += 1
+                name, []).append(compact_id)
 
         stitched_messages = []
 
-        next_id = 0
         self.pbar = tqdm(total=len(source_messages),
                     desc="Step 1/2: Stitching messages")
-        while next_id < len(source_messages):
-            next_message = source_messages[next_id]
-            self.pbar.update()
-
-            if next_message.get("type") != "message":
-                if next_message.get("type") != "service":
-                    next_id += 1
-                    continue
-
-                stitched_messages.append(
-                    self.parse_service_message(next_message))
-                next_id += 1
+        self._progress = 0
+
+        # Two-pointer pass: `message` is the current anchor,
+        # `next_message` the single message of lookahead.
+        source_iter = iter(source_messages)
+        next_message = next(source_iter, None)
+        while next_message is not None:
+            message, next_message = next_message, next(source_iter, None)
+            self.tick_progress()
+
+            if message.get("type") != "message":
+                if message.get("type") == "service":
+                    stitched_messages.append(
+                        self.parse_service_message(message))
                 continue
 
-            parsed_msg = self.parse_message_data(next_message)
+            parsed_msg = self.parse_message_data(message)
 
-            next_id = self.combine_messages(
-                next_message, next_id, parsed_msg,
-                source_messages
-            )
+            next_message = self.combine_messages(
+                message, parsed_msg, source_iter, next_message)
             stitched_messages.append(parsed_msg)
 
+        self.pbar.update(self._progress & 0xFF)
         self.pbar.close()
+        self.media.finish_copies()
         return stitched_messages, author_map, self.masking.enabled
 
-    @staticmethod
-    def check_attributes(message1: dict, message2: dict,
-                         same: tuple = None, has: tuple = None) -> bool:
-        if not same:
-            same = ()
-        if not has:
-            has = ()
-
-        for attribute in same:
-            if message1.get(attribute) != message2.get(attribute):
-                return False
-        for attribute in has:
-            if (attribute not in message1) or (attribute not in message2):
-                return False
-        return True
+    def tick_progress(self) -> None:
+        """
+        Counts a processed message, flushing the progress bar every 256
+        messages: per-message tqdm updates lock and write to stderr.
+        """
+        self._progress += 1
+        if not self._progress & 0xFF:
+            self.pbar.update(256)
 
-    def combine_messages(self, message: dict,
-                         message_id: int, parsed_message: dict,
-                         source_messages: list) -> int:
-        next_id = message_id + 1
-        if not len(source_messages) > next_id:
-            return next_id
+    def combine_messages(self, message: dict, parsed_message: dict,
+                         source_iter, next_message: dict | None
+                         ) -> dict | None:
+        """
+        Merges messages continuing the anchor into parsed_message.
+        Consumes them from source_iter and returns the first message
+        that does not belong to the run (or None when exhausted).
+        """
+        # The anchor message's attributes are invariant in this loop;
+        # look them up once instead of on every candidate.
+        anchor = (message.get("from_id"), message.get("forwarded_from"),
+                  message.get("date_unixtime"))
+        anchor_id = message["id"]
 
-        next_message = source_messages[next_id]
-        while self.check_attributes(
-                message, next_message,
-                ("from_id", "forwarded_from", "date_unixtime")):
+        while next_message is not None and anchor == (
+                next_message.get("from_id"),
+                next_message.get("forwarded_from"),
+                next_message.get("date_unixtime")):
 
-            self.pbar.update()
+            self.tick_progress()
 
             next_text = self.masking.apply(
                 self.format_text_entities_to_markdown(
@@ -340,14 +351,10 @@ class MessageProcessor:
 
             self.combine_reactions(next_message, parsed_message)
 
-            self.id_alias_map[next_message["id"]] = message["id"]
-            next_id += 1
+            self.id_alias_map[next_message["id"]] = anchor_id
+            next_message = next(source_iter, None)
 
-            if not len(source_messages) > next_id:
-                return next_id
-            next_message = source_messages[next_id]
-
-        return next_id
+        return next_message
 
     def combine_reactions(self, next_message: dict,
                           parsed_message: dict) -> None:
@@ -368,32 +375,16 @@ class MessageProcessor:
             if next_reaction["type"] == "paid":
                 next_shape = "⭐️"
 
-            # Check if this reaction already exists in our list
-            found = False
-            for reaction_id in range(len(parsed_message["reactions"])):
-                reaction = parsed_message["reactions"][reaction_id]
-                if reaction.get(next_shape) is not None:
-                    parsed_message["reactions"][reaction_id][
-                        next_shape] += next_count
-                    found = True
-                    break
-
-            if not found:
-                parsed_message["reactions"].append({
-                    next_shape: next_count
-                })
-
-            if not next_reaction.get("recent"):
-                continue
-
-            for reaction_id in range(len(parsed_message["reactions"])):
-                if not parsed_message["reactions"][reaction_id].get(
-                        next_shape):
-                    continue
+            if (reaction := self._reaction_index.get(next_shape)) is not None:
+                reaction[next_shape] += next_count
+            else:
+                reaction = {next_shape: next_count}
+                parsed_message["reactions"].append(reaction)
+                self._reaction_index[next_shape] = reaction
 
-                parsed_message["reactions"][reaction_id].setdefault(
-                    "recent", []).extend(self.minimise_recent_reactions(
-                    next_reaction))
+            if next_reaction.get("recent"):
+                reaction.setdefault("recent", []).extend(
+                    self.minimise_recent_reactions(next_reaction))
 
     def minimise_recent_reactions(self, reactions: dict) -> list[dict]:
         recent = []
@@ -415,6 +406,7 @@ class MessageProcessor:
 
     def parse_message_data(self, message: dict) -> dict:
         """Parses a single message using the author map."""
+        self._reaction_index = {}
         parsed_message = {
             "id": message["id"],
             "time": message["date"],
@@ -475,12 +467,12 @@ class MessageProcessor:
                 shape_value = reaction.get("emoji") or reaction.get(
                     "document_id") or "⭐️"
 
-                parsed_message["reactions"].append({
-                    shape_value: reaction["count"]
-                })
+                parsed_reaction = {shape_value: reaction["count"]}
+                parsed_message["reactions"].append(parsed_reaction)
+                self._reaction_index[shape_value] = parsed_reaction
 
                 if reaction.get("recent"):
-                    parsed_message["reactions"][-1][
+                    parsed_reaction[
                         "recent"] = self.minimise_recent_reactions(reaction)
 
         return parsed_message
@@ -721,6 +713,32 @@ class MessageProcessor:
             return data
         return message
 
+    def attach_transcriptions(self, messages: list) -> bool:
+        """
+        Transcribes queued media and attaches the texts to the stitched
+        messages. Returns whether anything was transcribed.
+        """
+        if not (transcripts := self.media.batch_transcribe()):
+            return False
+
+        for message in messages:
+            media = message.get("media")
+            if not media:
+                continue
+
+            if isinstance(media, str):
+                if media in transcripts:
+                    message["transcription"] = transcripts[media]
+                continue
+
+            transcriptions = [
+                transcripts[file_name] for file_name in media
+                if file_name in transcripts]
+            if transcriptions:
+                message["transcription"] = transcriptions
+
+        return True
+
     def fix_reply_ids(self, messages: list) -> None:
         """
         Goes through the stitched messages and fixes reply IDs